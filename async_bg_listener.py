@@ -1,206 +1,750 @@
 #!/usr/bin/env python
 import argparse
+import collections
 import logging
+import logging.handlers
 import os
 import queue
+import random
+import select
+import selectors
 import signal
 import sys
 import threading
 import time
-from typing import Optional
+from typing import Deque, Dict, List, Optional, Type
 
 import psycopg2
+import psycopg2.errorcodes
 import psycopg2.extensions
 
 
 # --- Функции для настройки логирования ---
+LOG_FORMAT = '%(asctime)-15s | %(levelname)-7s | %(filename)-25s:%(lineno)4s | %(message)s'
+# На уровне DEBUG дополнительно выводится имя функции
+LOG_FORMAT_DEBUG = '%(asctime)-15s | %(levelname)-7s | %(filename)-25s:%(lineno)4s - \
+%(funcName)25s() | %(message)s'
+# Фоновый поток, который пишет записи лога в файл или на консоль
+_log_listener: Optional[logging.handlers.QueueListener] = None
+
+
 def setup_logging(level: str, log_file: Optional[str] = None):
     """
     Настраивает логирование в файл или на консоль.
+    Записи передаются через очередь и выводятся отдельным потоком,
+    поэтому рабочие потоки не ждут файлового ввода-вывода.
     :param level: Уровень логирования (например, 'DEBUG', 'INFO', 'WARNING', 'ERROR').
     :param log_file: Путь к файлу лога. Если None, логи идут в консоль.
     """
-    LOG_FORMAT = '%(asctime)-15s | %(levelname)-7s | %(filename)-25s:%(lineno)4s - \
-%(funcName)25s() | %(message)s'
+    global _log_listener
     # Преобразуем строковый уровень в константу logging
     numeric_level = getattr(logging, level.upper(), logging.INFO)
 
     if not isinstance(numeric_level, int):
         raise ValueError(f'Invalid log level: {level}')
+    # Процесс и поток в формате не выводятся: не собираем их для каждой записи
+    logging.logThreads = False
+    logging.logProcesses = False
+    logging.logMultiprocessing = False
     handlers = []
 
     if log_file:
         # Создаем директорию для файла лога, если она не существует
-        log_dir = os.path.dirname(os.path.abspath(log_file))
+        # (файл в текущей директории создания директории не требует)
+        log_dir = os.path.dirname(log_file)
 
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
+        if log_dir:
+            os.makedirs(log_dir, exist_ok=True)
         handlers.append(logging.FileHandler(log_file, encoding='utf-8'))
     else:
         handlers.append(logging.StreamHandler(sys.stdout))  # По умолчанию в stdout
+    formatter = logging.Formatter(LOG_FORMAT_DEBUG if numeric_level <= logging.DEBUG
+                                  else LOG_FORMAT)
+
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    # Строку формирует обработчик в фоновом потоке, здесь только подставляются аргументы
+    queue_handler.setFormatter(logging.Formatter('%(message)s'))
+    stop_logging()
     logging.basicConfig(
         level=numeric_level,
-        format=LOG_FORMAT,
-        handlers=handlers,
+        handlers=[queue_handler],
         force=True  # Перенастраиваем, если logging уже был настроен
     )
+    _log_listener = logging.handlers.QueueListener(log_queue, *handlers)
+    _log_listener.start()
+
+
+def stop_logging():
+    """
+    Останавливает фоновый поток логирования, дописав все записи из очереди,
+    и закрывает его обработчики.
+    """
+    global _log_listener
+
+    if _log_listener is not None:
+        _log_listener.stop()
+        # basicConfig(force=True) закрывает только QueueHandler, файл закрываем сами
+        for handler in _log_listener.handlers:
+            handler.close()
+        _log_listener = None
 
 
 # Логгер будет использовать конфигурацию из setup_logging
 logger = logging.getLogger('NotifyListener')
 
+# Один запрос на пачку идентификаторов вместо callproc на каждое уведомление.
+# Результаты bg_comp не нужны: сервер возвращает только число вызовов.
+# Запрос подготавливается один раз на соединение и не планируется заново.
+# Массив параметра приводится к типу arg_id на сервере
+BG_COMP_PREPARE_SQL = ("PREPARE bg_comp_batch({param_type}[]) AS "
+                       "SELECT count(*) FROM unnest($1::{arg_type}[]) AS t(arg_id), "
+                       "LATERAL arc_energo.bg_comp(arg_id := t.arg_id)")
+BG_COMP_EXECUTE_SQL = "EXECUTE bg_comp_batch(%s)"
+# Тип аргумента arg_id функции arc_energo.bg_comp по данным каталога
+BG_COMP_ARG_TYPE_SQL = (
+    "SELECT DISTINCT format('%I.%I', p.udt_schema, p.udt_name) "
+    "FROM information_schema.parameters p "
+    "JOIN information_schema.routines r USING (specific_schema, specific_name) "
+    "WHERE r.routine_schema = 'arc_energo' AND r.routine_name = 'bg_comp' "
+    "AND p.parameter_name = 'arg_id' AND p.parameter_mode IN ('IN', 'INOUT')")
+# Параметры libpq для соединения LISTEN: TCP keepalive и TCP_USER_TIMEOUT (мс),
+# чтобы "зависшее" соединение обнаруживалось примерно за 30 секунд,
+# а не за время системного таймаута TCP (до 15 минут).
+# tcp_user_timeout передаем только с libpq 12 или новее: более старая libpq
+# отвергает неизвестный параметр и соединение не устанавливается
+LISTEN_KEEPALIVE_PARAMS = {
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3,
+}
+if psycopg2.extensions.libpq_version() >= 120000:
+    LISTEN_KEEPALIVE_PARAMS['tcp_user_timeout'] = 30000
+# Типы arg_id, которые можно задать явно, и преобразование payload для каждого из них.
+# Целочисленный payload передается серверу числом, без приведения из текста.
+# Без явного типа он определяется по каталогу, а payload передаются текстом
+ARG_TYPES = {
+    'text': None,
+    'bigint': int,
+    'integer': int,
+}
+
+
+def _safe_close(conn: Optional[psycopg2.extensions.connection], what: str):
+    """
+    Закрывает соединение, если оно открыто, не выбрасывая исключений.
+    :param conn: соединение или None
+    :param what: описание соединения для лога
+    """
+
+    if conn is None or conn.closed:
+        return
+    try:
+        conn.close()
+    except (psycopg2.Error, OSError) as e:
+        logger.debug("Error closing %s: %s", what, e, exc_info=True)
+
 # --- Класс слушателя ---
 
 
+class _ReadWaiter:
+    """
+    Ожидание готовности дескрипторов к чтению: select.epoll там, где он есть (Linux),
+    иначе selectors.DefaultSelector.
+    """
+
+    def __init__(self, *fds: int):
+        self._epoll = None
+        self._selector = None
+
+        if hasattr(select, 'epoll'):
+            self._epoll = select.epoll()
+
+            for fd in fds:
+                self._epoll.register(fd, select.EPOLLIN)
+        else:
+            self._selector = selectors.DefaultSelector()
+
+            for fd in fds:
+                self._selector.register(fd, selectors.EVENT_READ)
+
+    def wait(self, timeout: float) -> List[int]:
+        """
+        Ожидает готовности хотя бы одного дескриптора.
+        :param timeout: максимальное время ожидания (сек)
+        :return: список готовых к чтению дескрипторов
+        """
+
+        if self._epoll is not None:
+            return [fd for fd, _ in self._epoll.poll(timeout)]
+
+        return [key.fd for key, _ in self._selector.select(timeout)]
+
+    def close(self):
+        if self._epoll is not None:
+            self._epoll.close()
+        else:
+            self._selector.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class _HandlerConnection(psycopg2.extensions.connection):
+    """
+    Соединение рабочего потока с долгоживущим курсором,
+    который переиспользуется между пачками уведомлений,
+    и подготовленным запросом bg_comp_batch.
+    """
+    _hot_cursor: Optional[psycopg2.extensions.cursor] = None
+    _bg_comp_prepared = False
+
+    def hot_cursor(self, arg_type: Optional[str]) -> psycopg2.extensions.cursor:
+        """
+        Возвращает курсор соединения, создавая его и подготавливая
+        запрос при первом обращении.
+        :param arg_type: SQL-тип аргумента arg_id; None - определить по каталогу
+        """
+
+        if self._hot_cursor is None or self._hot_cursor.closed:
+            self._hot_cursor = self.cursor()
+
+        if not self._bg_comp_prepared:
+            if arg_type is None:
+                param_type, arg_type = 'text', self._detect_arg_type()
+            else:
+                param_type = arg_type
+            self._hot_cursor.execute(BG_COMP_PREPARE_SQL.format(param_type=param_type,
+                                                                arg_type=arg_type))
+            self._bg_comp_prepared = True
+
+        return self._hot_cursor
+
+    def _detect_arg_type(self) -> str:
+        """
+        Определяет тип аргумента arg_id функции arc_energo.bg_comp по каталогу.
+        :return: имя типа, пригодное для подстановки в SQL
+        """
+        self._hot_cursor.execute(BG_COMP_ARG_TYPE_SQL)
+        types = [row[0] for row in self._hot_cursor.fetchall()]
+
+        if len(types) != 1:
+            raise psycopg2.ProgrammingError(
+                f"Cannot determine type of arc_energo.bg_comp(arg_id) from catalog: {types}, "
+                f"use --arg-type")
+        logger.debug("Detected arc_energo.bg_comp(arg_id) type: %s", types[0])
+
+        return types[0]
+
+
 class NotificationListener:
-    def __init__(self, db_uri: str, channel: str = 'do_bg_comp', max_workers: int = 5):
+    """
+    Слушатель LISTEN/NOTIFY на psycopg2 с пулом рабочих потоков.
+
+    Один поток слушателя ждет данных на сокете libpq и раскладывает уведомления
+    по очередям рабочих потоков. psycopg2 отпускает GIL на время сетевого
+    ожидания libpq, поэтому рабочие потоки, ждущие ответа сервера, не мешают
+    друг другу и слушателю.
+
+    Соединение LISTEN (listen_conn) выделено отдельно: его открывает, использует
+    и закрывает только поток слушателя. Оно не входит в число соединений рабочих
+    потоков (по одному на поток, max_workers), поэтому нагрузка обработчиков
+    не может задержать получение уведомлений.
+    """
+    # Максимальное время (сек) ожидания данных на сокете слушателя
+    LISTEN_SELECT_TIMEOUT = 1.0
+    # Параметры переподключения слушателя
+    RECONNECT_DELAY = 1.0
+    RECONNECT_BACKOFF = 2.0
+    MAX_RECONNECT_DELAY = 60.0
+    # После стольких неудачных подключений подряд попытки приостанавливаются
+    BREAKER_THRESHOLD = 5
+    # Пауза (сек) перед пробным запросом при разомкнутом размыкателе
+    BREAKER_COOLDOWN = 30.0
+    # Коды ошибок PostgreSQL, после которых переподключаемся без задержки
+    IMMEDIATE_RETRY_PGCODES = frozenset({psycopg2.errorcodes.ADMIN_SHUTDOWN})
+    # Емкость очереди каждого рабочего потока
+    QUEUE_SIZE = 64
+    # Сколько ожидать (сек) место в переполненной очереди, прежде чем отбросить уведомление
+    QUEUE_PUT_TIMEOUT = 0.5
+    # Сколько последних отброшенных payload хранить
+    DEAD_LETTER_SIZE = 10000
+
+    def __init__(self, db_uri: str, channel: str = 'do_bg_comp', max_workers: int = 5,
+                 batch_max: int = 64, batch_debounce: float = 0.01, arg_type: Optional[str] = None):
         """
         Инициализация слушателя уведомлений.
         :param db_uri: URI подключения к PostgreSQL
         :param channel: имя канала для подписки
         :param max_workers: максимальное количество потоков для обработки уведомлений
+        :param batch_max: максимальное количество уведомлений, обрабатываемых за один вызов
+        :param batch_debounce: время (сек) ожидания новых уведомлений для пачки, 0 - не ждать
+        :param arg_type: SQL-тип аргумента arg_id функции bg_comp (см. ARG_TYPES),
+            None - определить по каталогу при подготовке запроса
         """
+
+        if arg_type is not None and arg_type not in ARG_TYPES:
+            raise ValueError(f'Invalid arg type: {arg_type}')
         self.db_uri = db_uri
         self.channel = channel
         self.max_workers = max_workers
-        self.notification_queue = queue.Queue()
+        self.batch_max = max(1, batch_max)
+        self.batch_debounce = batch_debounce
+        self.arg_type = arg_type
+        # Отдельная ограниченная очередь на каждый рабочий поток: уведомления с одинаковым
+        # payload всегда попадают к одному потоку, а блокировка не общая
+        self.queues: List[queue.Queue] = [queue.Queue(maxsize=self.QUEUE_SIZE)
+                                          for _ in range(max_workers)]
+        # Payload уведомлений, не поместившихся в очередь или не обработанных из-за ошибки
+        self.dead_letters: Deque[str] = collections.deque(maxlen=self.DEAD_LETTER_SIZE)
         self.workers = []
-        self.running = False
-        self.conn: Optional[psycopg2.extensions.connection] = None
-        # Событие для сигнализации о завершении работы
+        self.listener_thread: Optional[threading.Thread] = None
+        # Соединение LISTEN, используется только потоком слушателя
+        self.listen_conn: Optional[psycopg2.extensions.connection] = None
+        # Событие для сигнализации о завершении работы, сброшено только во время работы
         self._stop_event = threading.Event()
+        self._stop_event.set()
+        # Self-pipe для пробуждения слушателя из stop(), создается в start()
+        self._wake_r: Optional[int] = None
+        self._wake_w: Optional[int] = None
+
+    @property
+    def running(self) -> bool:
+        """
+        Признак работы слушателя: start() вызван, а stop() еще нет.
+        """
 
-    def _handle_notification(self, notification: psycopg2.extensions.Notify):
+        return not self._stop_event.is_set()
+
+    def _handle_notification(self, notifications: List[psycopg2.extensions.Notify],
+                             hndl_cursor: psycopg2.extensions.cursor):
         """
-        Обработка уведомления. Этот метод должен быть переопределен в подклассе.
-        :param notification: объект уведомления
+        Обработка пачки уведомлений. Этот метод должен быть переопределен в подклассе.
+        :param notifications: список уведомлений
+        :param hndl_cursor: курсор соединения рабочего потока (autocommit)
         """
-        logger.info(f"Got notification on channel {notification.channel}: {notification.payload}")
+        # Повторные payload в одной пачке обрабатываются один раз, порядок сохраняется
+        payloads = list(dict.fromkeys(n.payload for n in notifications))
+        convert = ARG_TYPES.get(self.arg_type)
+
+        if convert is not None:
+            payloads = self._convert_payloads(payloads, convert)
+
+            if not payloads:
+                return
+        debug = logger.isEnabledFor(logging.DEBUG)
+
+        if debug:
+            logger.debug("Got %d notification(s) on channel %s: %s",
+                         len(notifications), notifications[0].channel, payloads)
         # Здесь должна быть ваша логика обработки уведомления
         # Пример:
-        try:
-            # Создаем отдельное соединение для обработчика, как обсуждалось ранее
-            # Это делает обработку более устойчивой к сбоям соединения в других частях
-            handler_conn = None
+        hndl_cursor.execute(BG_COMP_EXECUTE_SQL, (payloads,))
+
+        if debug:
+            logger.debug("Processed notifications: %s, rows=%s", payloads, hndl_cursor.fetchone()[0])
+
+    def _convert_payloads(self, payloads: List[str], convert) -> list:
+        """
+        Преобразует payload к типу arg_id. Некорректные значения пропускаются
+        и попадают в dead_letters.
+        :param payloads: список payload
+        :param convert: функция преобразования из ARG_TYPES
+        :return: список преобразованных значений без повторов
+        """
+        converted = []
+
+        for payload in payloads:
+            try:
+                converted.append(convert(payload))
+            except ValueError:
+                self.dead_letters.append(payload)
+                logger.warning("Skipping notification with invalid payload %r", payload)
+
+        return list(dict.fromkeys(converted))
+
+    def _collect_batch(self, notification_queue: queue.Queue,
+                       first: psycopg2.extensions.Notify) -> List[psycopg2.extensions.Notify]:
+        """
+        Набирает пачку уведомлений из очереди: до batch_max штук или пока
+        не истечет окно batch_debounce с момента получения первого уведомления.
+        Признак остановки (None) в пачку не попадает и возвращается в очередь.
+        :param notification_queue: очередь рабочего потока
+        :param first: уже полученное из очереди уведомление
+        :return: список уведомлений (не более batch_max)
+        """
+        batch = [first]
+        deadline = time.monotonic() + self.batch_debounce
+
+        while len(batch) < self.batch_max:
             try:
-                handler_conn = psycopg2.connect(self.db_uri)
-                # handler_conn.set_isolation_level(...) если нужно
-                hndl_cursor = handler_conn.cursor()
-                hndl_cursor.callproc('arc_energo.bg_comp',
-                                     {'arg_id': notification.payload})
-                results = hndl_cursor.fetchall()
-                logger.info(f"Processed notification: {notification.payload}, results={results}")
-                # handler_conn.commit() если isolation level не autocommit и были изменения
-            finally:
-                if handler_conn and not handler_conn.closed:
-                    try:
-                        handler_conn.close()
-                    except (psycopg2.Error, OSError) as e:  # Исправлено: конкретные исключения
-                        logger.debug(f"Error closing handler connection: {e}", exc_info=True)
-        except Exception as e:
-            logger.error(f"Error processing notification: {e}", exc_info=True)
-
-    def _worker_loop(self):
+                notification = notification_queue.get_nowait()
+            except queue.Empty:
+                # Даем короткое окно для догоняющих уведомлений из того же всплеска
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    break
+                try:
+                    notification = notification_queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+
+            if notification is None:
+                # Остановка: обработаем набранное, выход - на следующем get()
+                notification_queue.put(None)
+                break
+            batch.append(notification)
+
+        return batch
+
+    def _worker_loop(self, index: int):
         """
         Цикл обработки уведомлений в рабочем потоке.
+        Поток завершается, получив из своей очереди None от stop().
+        :param index: номер рабочего потока и его очереди
         """
+        notification_queue = self.queues[index]
+        # Соединение закреплено за потоком на все время его работы
+        handler_conn: Optional[_HandlerConnection] = None
 
-        while self.running or not self.notification_queue.empty():
+        try:
+            while True:
+                notification = notification_queue.get()
+
+                if notification is None:
+                    return
+                batch = self._collect_batch(notification_queue, notification)
+
+                try:
+                    handler_conn = self._process(batch, handler_conn)
+                except Exception as e:
+                    logger.error("Worker error: %s", e, exc_info=True)
+        finally:
+            _safe_close(handler_conn, 'handler connection')
+
+    def _dispatch(self, notify: psycopg2.extensions.Notify):
+        """
+        Передает уведомление в очередь рабочего потока, выбранного по payload.
+        Если очередь остается заполненной, уведомление откладывается в dead_letters.
+        :param notify: объект уведомления
+        """
+        try:
+            self.queues[hash(notify.payload) % self.max_workers].put(
+                notify, timeout=self.QUEUE_PUT_TIMEOUT)
+        except queue.Full:
+            self.dead_letters.append(notify.payload)
+            logger.warning("Notification queue full, dropping %s", notify.payload)
+
+    def _connect_handler(self) -> _HandlerConnection:
+        """
+        Открывает соединение рабочего потока в режиме autocommit.
+        """
+        handler_conn = psycopg2.connect(self.db_uri, connection_factory=_HandlerConnection)
+        handler_conn.autocommit = True
+
+        return handler_conn
+
+    def _process(self, notifications: List[psycopg2.extensions.Notify],
+                 handler_conn: Optional[_HandlerConnection]) -> Optional[_HandlerConnection]:
+        """
+        Обработка пачки уведомлений на соединении рабочего потока.
+        При разрыве соединения переподключается и повторяет обработку один раз.
+        Если пачка не обработана из-за ошибки запроса, соединение сохраняется,
+        а payload обрабатываются по одному.
+        Необработанные payload попадают в dead_letters.
+        :param notifications: список уведомлений
+        :param handler_conn: текущее соединение рабочего потока или None
+        :return: соединение для следующих пачек или None, если оно потеряно
+        """
+        payloads = list(dict.fromkeys(n.payload for n in notifications))
+
+        for attempt in range(2):
             try:
-                # Используем timeout для проверки флага running
-                notification = self.notification_queue.get(timeout=1)
+                if handler_conn is None or handler_conn.closed:
+                    handler_conn = self._connect_handler()
+                self._handle_notification(notifications, handler_conn.hot_cursor(self.arg_type))
 
-                if notification is not None:
-                    self._handle_notification(notification)
-                self.notification_queue.task_done()
-            except queue.Empty:
-                continue  # Проверим running снова
+                return handler_conn
             except Exception as e:
-                logger.error(f"Worker error: {e}", exc_info=True)
-
-    def _listen_loop(self):
+                # Переподключаемся, только если соединение действительно потеряно.
+                # OperationalError бывает и на живом соединении (QueryCanceled,
+                # lock_timeout), его обрабатываем как ошибку запроса
+                if handler_conn is None or handler_conn.closed \
+                        or isinstance(e, psycopg2.InterfaceError):
+                    _safe_close(handler_conn, 'handler connection')
+                    handler_conn = None
+
+                    if attempt == 0:
+                        logger.warning("Handler connection lost or failed: %s, reconnecting", e)
+                    else:
+                        self.dead_letters.extend(payloads)
+                        logger.error("Error processing notifications %s: %s", payloads, e,
+                                     exc_info=True)
+
+                    continue
+                # Соединение в режиме autocommit остается пригодным после ошибки запроса,
+                # поэтому ошибка одного payload не должна терять остальные.
+                # Если запрос не удалось подготовить, по одному обрабатывать нечем
+                if len(payloads) > 1 and handler_conn._bg_comp_prepared:
+                    logger.warning("Batch of %d payloads failed: %s, processing one by one",
+                                   len(payloads), e)
+                    self._process_separately(notifications, handler_conn.hot_cursor(self.arg_type))
+                else:
+                    self.dead_letters.extend(payloads)
+                    logger.error("Error processing notifications %s: %s", payloads, e,
+                                 exc_info=True)
+
+                return handler_conn
+
+        return None
+
+    def _process_separately(self, notifications: List[psycopg2.extensions.Notify],
+                            hndl_cursor: psycopg2.extensions.cursor):
         """
-        Основной цикл прослушивания уведомлений.
+        Обработка уведомлений пачки по одному payload после ошибки всей пачки.
+        Payload, которые не удалось обработать, попадают в dead_letters.
+        :param notifications: список уведомлений
+        :param hndl_cursor: курсор соединения рабочего потока
         """
-        reconnect_delay = 1.0
-        reconnect_backoff = 2.0
-        max_reconnect_delay = 60.0
+        groups: Dict[str, List[psycopg2.extensions.Notify]] = {}
 
-        while self.running:
+        for notification in notifications:
+            groups.setdefault(notification.payload, []).append(notification)
+        failed = []
+
+        for payload, group in groups.items():
+            if hndl_cursor.connection.closed:
+                failed.append(payload)  # Соединение потеряно: остальные не обработать
+
+                continue
             try:
-                logger.info("Attempting to connect to database...")
-                # Устанавливаем соединение
-                self.conn = psycopg2.connect(self.db_uri)
-                self.conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
-                cursor = self.conn.cursor()
-                cursor.execute(f"LISTEN {self.channel};")
-                logger.info(f"Successfully connected and listening to channel '{self.channel}'...")
-                reconnect_delay = 1.0  # Сброс задержки при успешном подключении
-
-                while self.running:
-                    # Ожидаем уведомлений с проверкой флага running
-                    # Используем poll() и проверяем флаг running регулярно
-                    try:
-                        # poll() может блокировать, поэтому используем select/poll
-                        # Но для простоты и совместимости оставим time.sleep и poll()
-                        # с коротким циклом. Для более высокой отзывчивости
-                        # можно использовать select.select() или select.poll()
-                        # на self.conn.fileno(), но это сложнее.
-                        self.conn.poll()
-                    except psycopg2.OperationalError:
-                        # poll() может выбросить OperationalError при разрыве
-                        raise  # Перехватим ниже как ошибку соединения
-
-                    # Обрабатываем все полученные уведомления
-
-                    while self.conn.notifies:
-                        notify = self.conn.notifies.pop(0)
-                        # Проверяем running перед добавлением в очередь
-
-                        if self.running:
-                            self.notification_queue.put(notify)
-                        else:
-                            logger.debug("Ignoring notification, listener is stopping.")
-                    # time.sleep(0.1) # Или используйте select/poll для более отзывчивости
-                    # Вместо time.sleep используем wait с timeout, чтобы быстрее реагировать на stop
-
-                    if self._stop_event.wait(0.1):
-                        break  # Получен сигнал остановки
-
-            except (psycopg2.OperationalError, psycopg2.InterfaceError,  # Ошибки psycopg2
-                    ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
-                    OSError) as e:  # Исправлено: конкретные исключения
-                logger.warning(f"Database connection lost or failed: {e}")
-
-                if self.conn and not self.conn.closed:
-                    try:
-                        self.conn.close()
-                    except (psycopg2.Error, OSError) as close_e:  # Исправлено: конкретные исключения
-                        logger.debug(
-                            f"Error closing connection during reconnect: {close_e}", exc_info=True)
-                    self.conn = None
-
-                if not self.running:
-                    break  # Если остановка запрошена, не пытаемся переподключиться
-                # Логика повтора с экспоненциальной задержкой
-                logger.info(f"Reconnecting in {reconnect_delay:.2f} seconds...")
-                time.sleep(reconnect_delay)
-                reconnect_delay = min(reconnect_delay * reconnect_backoff, max_reconnect_delay)
+                self._handle_notification(group, hndl_cursor)
             except Exception as e:
-                logger.error(f"Unexpected error in listen loop: {e}", exc_info=True)
+                failed.append(payload)
+                logger.error("Error processing notification %s: %s", payload, e, exc_info=True)
 
-                if self.running:  # Останавливаем только если еще не остановлены
-                    self.stop()
+        if failed:
+            self.dead_letters.extend(failed)
+            logger.error("Failed to process payloads: %s", failed)
 
+    def _drain_notifies(self):
+        """
+        Передает рабочим потокам все уведомления, полученные соединением слушателя.
+        """
+        # Забираем копию списка и очищаем его одной операцией вместо pop(0),
+        # который сдвигает весь список на каждом элементе. Список очищается
+        # до раздачи, поэтому ошибка в _dispatch() не приведет к повторной отправке
+        if not self.listen_conn.notifies:
+            return
+        notifies = self.listen_conn.notifies[:]
+        self.listen_conn.notifies.clear()
+        # Проверяем running перед каждым добавлением в очередь: при заполненных
+        # очередях _dispatch() ждет QUEUE_PUT_TIMEOUT и задержал бы stop()
+        for notify in notifies:
+            if not self.running:
+                logger.debug("Ignoring notification, listener is stopping.")
                 break
-            finally:
-                if self.conn and not self.conn.closed:
-                    try:
-                        self.conn.close()
-                    except (psycopg2.Error, OSError) as e:  # Исправлено: конкретные исключения
-                        logger.debug(
-                            f"Error closing database connection in finally: {e}", exc_info=True)
-                    self.conn = None
+            self._dispatch(notify)
+
+    def _wakeup(self):
+        """
+        Пробуждает поток слушателя, ожидающий в select().
+        """
+
+        if self._wake_w is None:
+            return
+        try:
+            os.write(self._wake_w, b'x')
+        except (BlockingIOError, OSError) as e:  # Канал уже заполнен или закрыт
+            logger.debug("Error writing to wakeup pipe: %s", e)
+
+    def _drain_wakeup(self):
+        """
+        Вычитывает все байты из self-pipe после пробуждения.
+        """
+        try:
+            while os.read(self._wake_r, 4096):
+                pass
+        except (BlockingIOError, OSError):
+            pass
+
+    def _close_wakeup(self):
+        """
+        Закрывает оба конца self-pipe.
+        """
+
+        for fd in (self._wake_r, self._wake_w):
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError as e:
+                    logger.debug("Error closing wakeup pipe: %s", e, exc_info=True)
+        self._wake_r = self._wake_w = None
+
+    def _wait_async(self, conn: psycopg2.extensions.connection) -> bool:
+        """
+        Дожидается завершения асинхронной операции на соединении,
+        регулярно проверяя флаг running.
+        :param conn: асинхронное соединение psycopg2
+        :return: True, если операция завершена, False, если запрошена остановка
+        """
+
+        while self.running:
+            state = conn.poll()
+
+            if state == psycopg2.extensions.POLL_OK:
+                return True
+
+            if state == psycopg2.extensions.POLL_READ:
+                rlist, wlist = [conn.fileno()], []
+            elif state == psycopg2.extensions.POLL_WRITE:
+                rlist, wlist = [], [conn.fileno()]
+            else:
+                raise psycopg2.OperationalError(f"Bad state from poll: {state}")
+
+            if self._wake_r is not None:
+                rlist.append(self._wake_r)  # stop() прерывает ожидание немедленно
+            select.select(rlist, wlist, [], self.LISTEN_SELECT_TIMEOUT)
+
+        return False
+
+    def half_open_probe(self) -> bool:
+        """
+        Пробный запрос SELECT 1 на отдельном соединении перед возобновлением LISTEN.
+        :return: True, если база данных отвечает
+        """
+        conn = None
+
+        try:
+            conn = psycopg2.connect(self.db_uri, async_=True)
+
+            if not self._wait_async(conn):
+                return False
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1")
+
+            return self._wait_async(conn)
+        except (psycopg2.Error, OSError) as e:
+            logger.info("Database probe failed: %s", e)
+
+            return False
+        finally:
+            _safe_close(conn, 'probe connection')
+
+    def _listen_loop(self):
+        """
+        Основной цикл прослушивания уведомлений.
+        """
+        failures = 0  # Неудачных подключений подряд
+
+        try:
+            while self.running:
+                established = False  # Соединение установлено и слушает канал
+
+                try:
+                    logger.info("Attempting to connect to database...")
+                    # Устанавливаем асинхронное соединение (всегда в режиме autocommit),
+                    # чтобы зависшее подключение не блокировало остановку
+                    self.listen_conn = psycopg2.connect(self.db_uri, async_=True,
+                                                        **LISTEN_KEEPALIVE_PARAMS)
+
+                    if not self._wait_async(self.listen_conn):
+                        break
+                    cursor = self.listen_conn.cursor()
+                    cursor.execute(f"LISTEN {self.channel};")
+
+                    if not self._wait_async(self.listen_conn):
+                        break
+                    logger.info("Successfully connected and listening to channel '%s'...",
+                                self.channel)
+                    # Сброс задержки при успешном подключении
+                    failures = 0
+                    established = True
+
+                    # Ждем данных на сокете libpq вместо периодического poll() + sleep
+                    # Таймаут нужен только для регулярной проверки флага running
+                    # stop() пишет в self-pipe, чтобы прервать ожидание немедленно
+                    conn_fd = self.listen_conn.fileno()
+
+                    with _ReadWaiter(conn_fd, self._wake_r) as waiter:
+                        while self.running:
+                            # Уведомления, пришедшие вместе с ответом на LISTEN или на
+                            # предыдущий poll(), уже прочитаны libpq и не сделают сокет
+                            # готовым к чтению, поэтому разбираем их до ожидания
+                            self._drain_notifies()
+                            ready = waiter.wait(self.LISTEN_SELECT_TIMEOUT)
+
+                            if self._wake_r in ready:
+                                self._drain_wakeup()
+
+                            if conn_fd in ready:
+                                # poll() может выбросить OperationalError при разрыве,
+                                # перехватим ниже как ошибку соединения
+                                self.listen_conn.poll()
+
+                except (psycopg2.OperationalError, psycopg2.InterfaceError,  # Ошибки psycopg2
+                        ConnectionResetError, ConnectionAbortedError, BrokenPipeError,
+                        OSError) as e:  # Исправлено: конкретные исключения
+                    logger.warning("Database connection lost or failed: %s", e)
+                    _safe_close(self.listen_conn, 'listener connection during reconnect')
+                    self.listen_conn = None
+
+                    if not self.running:
+                        break  # Если остановка запрошена, не пытаемся переподключиться
+
+                    if established or getattr(e, 'pgcode', None) in self.IMMEDIATE_RETRY_PGCODES:
+                        # Разрыв работавшего соединения (в т.ч. штатное закрытие сервером:
+                        # на простаивающем соединении poll() выбрасывает ошибку без pgcode,
+                        # а текст FATAL зависит от lc_messages) - переподключаемся сразу,
+                        # без задержки и без учета в счетчике неудач. Задержка применяется
+                        # только к неудачным попыткам подключения
+                        logger.info("Listener connection closed, reconnecting now")
+
+                        continue
+                    failures += 1
+
+                    if failures >= self.BREAKER_THRESHOLD:
+                        # Размыкатель: не подключаемся, пока пробный запрос не пройдет
+                        logger.warning("%d consecutive connection failures, pausing reconnects",
+                                       failures)
+
+                        while self.running:
+                            self._stop_event.wait(self.BREAKER_COOLDOWN)
+
+                            if self.running and self.half_open_probe():
+                                break
+                        failures = 0
+
+                        continue
+                    # Логика повтора с экспоненциальной задержкой и случайным разбросом,
+                    # чтобы клиенты не переподключались одновременно. Верхняя граница
+                    # считается по числу неудач, а не от предыдущей случайной задержки
+                    envelope = min(self.RECONNECT_DELAY * self.RECONNECT_BACKOFF ** failures,
+                                   self.MAX_RECONNECT_DELAY)
+                    reconnect_delay = random.uniform(self.RECONNECT_DELAY, envelope)
+                    logger.info("Reconnecting in %.2f seconds...", reconnect_delay)
+                    # Ожидание прерывается сразу при вызове stop()
+                    self._stop_event.wait(reconnect_delay)
+
+                    continue
+                except Exception as e:
+                    logger.error("Unexpected error in listen loop: %s", e, exc_info=True)
+
+                    if self.running:  # Останавливаем только если еще не остановлены
+                        self.stop()
+
+                    break
+        finally:
+            # Соединение закрывается один раз, при выходе из цикла
+            _safe_close(self.listen_conn, 'listener connection')
+            self.listen_conn = None
 
     def start(self):
         """
@@ -211,19 +755,22 @@ class NotificationListener:
             logger.warning("Listener is already running")
 
             return
-        self.running = True
-        self._stop_event.clear()  # Сбрасываем событие
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        os.set_blocking(self._wake_w, False)
+        self._stop_event.clear()  # Сбрасываем событие, с этого момента running == True
         # Запускаем рабочие потоки
 
         for i in range(self.max_workers):
             worker = threading.Thread(
                 target=self._worker_loop,
+                args=(i,),
                 name=f"NotificationWorker-{i}",
                 daemon=True  # Демонизируем потоки
             )
             worker.start()
             self.workers.append(worker)
-            logger.info(f"Started worker thread {worker.name}")
+            logger.info("Started worker thread %s", worker.name)
         # Запускаем поток слушателя
         self.listener_thread = threading.Thread(
             target=self._listen_loop,
@@ -241,34 +788,34 @@ class NotificationListener:
         if not self.running:
             return
         logger.info("Stopping listener...")
-        self.running = False
-        self._stop_event.set()  # Устанавливаем событие для пробуждения слушателя
+        self._stop_event.set()  # Устанавливаем событие, running становится False
+        # Прерываем select() в потоке слушателя. Внутри libpq слушатель не блокируется:
+        # подключение, LISTEN и ожидание данных идут через select() с self-pipe
+        self._wakeup()
 
         # Ожидаем завершения потока слушателя
 
-        if hasattr(self, 'listener_thread') and self.listener_thread.is_alive():
+        # stop() может быть вызван и из самого потока слушателя при неожиданной ошибке
+
+        if (self.listener_thread is not None and self.listener_thread.is_alive()
+                and self.listener_thread is not threading.current_thread()):
             self.listener_thread.join(timeout=10)  # Увеличен timeout
 
             if self.listener_thread.is_alive():
                 logger.warning("Listener thread did not stop gracefully")
+        self._close_wakeup()
         # Ожидаем завершения рабочих потоков
-        # Ожидаем завершения обработки текущих задач в очереди
-        self.notification_queue.join()  # Блокирует до тех пор, пока task_done()
-        # не будет вызван для всех элементов
+        # None ставится в конец очереди, поэтому поток выходит,
+        # только обработав все задачи своей очереди
 
-        for worker in self.workers:
-            if worker.is_alive():
-                worker.join(timeout=5)
+        for notification_queue in self.queues:
+            notification_queue.put(None)
 
-                if worker.is_alive():
-                    logger.warning(f"Worker thread {worker.name} did not stop gracefully")
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
         # Закрываем соединение, если оно еще открыто (на всякий случай)
-
-        if self.conn and not self.conn.closed:
-            try:
-                self.conn.close()
-            except (psycopg2.Error, OSError) as e:  # Исправлено: конкретные исключения
-                logger.debug(f"Error closing connection in stop: {e}", exc_info=True)
+        _safe_close(self.listen_conn, 'listener connection in stop')
         logger.info("Listener stopped")
 
     def __enter__(self):
@@ -319,6 +866,26 @@ def parse_arguments():
         default=5,
         help='Количество рабочих потоков для обработки уведомлений. По умолчанию: 5'
     )
+    parser.add_argument(
+        '--batch-max', '-b',
+        type=int,
+        default=64,
+        help='Максимальное количество уведомлений в одном вызове обработчика. По умолчанию: 64'
+    )
+    parser.add_argument(
+        '--batch-debounce',
+        type=float,
+        default=0.01,
+        help='Время (сек) ожидания новых уведомлений для пачки. По умолчанию: 0.01'
+    )
+    parser.add_argument(
+        '--arg-type', '-t',
+        type=str,
+        default=None,
+        choices=list(ARG_TYPES),
+        help='SQL-тип аргумента arg_id функции arc_energo.bg_comp. '
+             'По умолчанию определяется по каталогу БД'
+    )
 
     return parser.parse_args()
 
@@ -331,7 +898,7 @@ _listener_instance: Optional[NotificationListener] = None
 def signal_handler(signum, frame):
     """Обработчик сигналов SIGINT и SIGTERM."""
     signame = signal.Signals(signum).name
-    logger.info(f"Received signal {signum} ({signame}). Initiating graceful shutdown...")
+    logger.info("Received signal %s (%s). Initiating graceful shutdown...", signum, signame)
 
     if _listener_instance:
         # Вызываем stop на экземпляре слушателя
@@ -345,7 +912,14 @@ def signal_handler(signum, frame):
 
 # --- Основная точка входа ---
 
-if __name__ == "__main__":
+
+def main(listener_class: Type[NotificationListener] = NotificationListener):
+    """
+    Запуск слушателя из командной строки.
+    :param listener_class: класс слушателя; подкласс NotificationListener
+        с собственным _handle_notification использует ту же точку входа
+    """
+    global _listener_instance
     # 1. Парсим аргументы
     args = parse_arguments()
 
@@ -364,10 +938,13 @@ if __name__ == "__main__":
     # SIGINT (Ctrl+C) будет работать как и раньше, вызывая KeyboardInterrupt
 
     # 4. Создаем и запускаем слушатель
-    listener = NotificationListener(
+    listener = listener_class(
         db_uri=args.db_uri,
         channel=args.channel,
-        max_workers=args.workers
+        max_workers=args.workers,
+        batch_max=args.batch_max,
+        batch_debounce=args.batch_debounce,
+        arg_type=args.arg_type
     )
     # Сохраняем ссылку на экземпляр для обработчика сигнала
     _listener_instance = listener
@@ -375,7 +952,7 @@ if __name__ == "__main__":
     try:
         listener.start()
         logger.info(
-            f"Notification listener started for channel '{args.channel}'. Press Ctrl+C to stop.")
+            "Notification listener started for channel '%s'. Press Ctrl+C to stop.", args.channel)
         # Основной цикл ожидания. Выход будет либо по KeyboardInterrupt (Ctrl+C),
         # либо по завершению работы слушателя (например, из-за сигнала)
 
@@ -387,3 +964,8 @@ if __name__ == "__main__":
         # Гарантируем остановку слушателя
         listener.stop()
         _listener_instance = None  # Очищаем ссылку
+        stop_logging()
+
+
+if __name__ == "__main__":
+    main()